@@ -1,34 +1,136 @@
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import streamlit as st
 import pandas as pd
 import datetime
+import hashlib
+import hmac
+import random
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import ExitStack, contextmanager
 
 # --- Configuration ---
 SCOPE = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
 SHEET_NAME = "StockFarmDB"
 
+# Tabs the app uses, with their header rows
+HEADERS = {
+    "Crops": ["User", "Ticker", "BuyPrice", "Quantity", "BuyDate", "Id"],
+    "History": ["User", "Time", "Type", "Ticker", "Price", "Quantity", "Date", "ProfitRate", "ProfitAmt"],
+    "Users": ["Nickname", "PasswordHash"],
+    "Guestbook": ["Receiver", "Sender", "Message", "Date"]
+}
+
+# Retry policy for Sheets API rate limits (429) and transient unavailability (503)
+BACKOFF_TRIES = 6
+BACKOFF_BASE = 0.5 # seconds
+BACKOFF_CAP = 30 # seconds
+RETRY_STATUS_CODES = (429, 503)
+
+# Process-wide {nickname: password_hash} map, rebuilt from the Users tab when stale
+USERS_CACHE_TTL = 30 # seconds
+_users_cache = {"ts": 0, "map": {}}
+
+def _tune_http(client):
+    """Mounts a larger keep-alive pool with transport-level retries on the client's HTTP session."""
+    # 429/503 are left to _call_with_backoff so gspread still raises APIError for them
+    adapter = HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=16,
+        max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[500, 502, 504], raise_on_status=False)
+    )
+    # gspread 6 moved the session onto client.http_client
+    session = getattr(client, "http_client", client).session
+    session.mount("https://", adapter)
+    return client
+
+def _call_with_backoff(fn, *args, **kwargs):
+    """Calls a gspread method, retrying 429/503 APIErrors with exponential backoff + jitter."""
+    for attempt in range(BACKOFF_TRIES):
+        try:
+            return fn(*args, **kwargs)
+        except gspread.exceptions.APIError as e:
+            response = getattr(e, "response", None)
+            code = getattr(response, "status_code", 0)
+            if code not in RETRY_STATUS_CODES or attempt == BACKOFF_TRIES - 1:
+                raise
+            delay = BACKOFF_BASE * 2 ** attempt + random.random()
+            # Respect the server's Retry-After hint when present
+            retry_after = response.headers.get("Retry-After") if response is not None else None
+            if retry_after and retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+            time.sleep(min(BACKOFF_CAP, delay))
+
+def _cell_data(value):
+    """Converts a Python value to a CellData dict (stored as-is, like append_row's RAW input)."""
+    if value == "" or value is None:
+        return {}
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return {"userEnteredValue": {"numberValue": value}}
+    return {"userEnteredValue": {"stringValue": str(value)}}
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _fetch_all_records(_ws, ws_name):
+    """Cached get_all_records() per worksheet name. Cleared by _clear_read_caches() after writes."""
+    return _call_with_backoff(_ws.get_all_records)
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _fetch_user_rows(_ws, ws_name, user_nickname, width):
+    """Cached rows whose first column is user_nickname, read from columns A..width only.
+
+    One values read of those columns, filtered in Python. Rows are padded to width.
+    """
+    last_col = gspread.utils.rowcol_to_a1(1, width).rstrip("1") # e.g. 6 -> "F"
+    # Unformatted values come back as native JSON numbers, not locale-formatted strings;
+    # date cells still come back as their displayed text instead of serial day numbers
+    values = _call_with_backoff(_ws.get_values, f"A:{last_col}", value_render_option="UNFORMATTED_VALUE",
+                                date_time_render_option="FORMATTED_STRING")
+    
+    rows = []
+    for row in values[1:]: # Skip headers
+        if row and str(row[0]) == user_nickname:
+            rows.append(list(row) + [""] * (width - len(row))) # API trims trailing empty cells
+    return rows
+
+def _clear_read_caches():
+    """Invalidates cached sheet reads after a write."""
+    _fetch_all_records.clear()
+    _fetch_user_rows.clear()
+
+@st.cache_resource
+def _get_gspread_client():
+    """Authorizes once per process and shares the client. Raises on failure, so failures aren't cached."""
+    # 1. Try Streamlit Secrets (Cloud Environment)
+    try:
+        # Check if secrets are available without crashing
+        if "gcp_service_account" in st.secrets:
+            creds_dict = st.secrets["gcp_service_account"]
+            creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, SCOPE)
+            return _tune_http(gspread.authorize(creds))
+    except:
+        pass # Secrets failed, fall back to local file
+
+    # 2. Try Local File (Local Environment)
+    creds = ServiceAccountCredentials.from_json_keyfile_name("service_account.json", SCOPE)
+    return _tune_http(gspread.authorize(creds))
+
 class SheetManager:
     def __init__(self):
+        self._ws_cache = {} # name -> Worksheet, resolved once per process
+        self._headers_ok = set() # worksheet titles whose header row was verified this process
+        self._write_locks = defaultdict(threading.Lock) # worksheet name -> Lock serializing writers
         self.client = self._connect()
         self.sheet = self._get_sheet()
 
     def _connect(self):
         """Connects to Google Sheets using robust authentication (Secrets or Local File)."""
-        # 1. Try Streamlit Secrets (Cloud Environment)
         try:
-            # Check if secrets are available without crashing
-            if "gcp_service_account" in st.secrets:
-                creds_dict = st.secrets["gcp_service_account"]
-                creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, SCOPE)
-                return gspread.authorize(creds)
-        except:
-            pass # Secrets failed, fall back to local file
-
-        # 2. Try Local File (Local Environment)
-        try:
-            creds = ServiceAccountCredentials.from_json_keyfile_name("service_account.json", SCOPE)
-            return gspread.authorize(creds)
+            return _get_gspread_client()
         except Exception as e:
             print(f"DEBUG: Connection Error: {e}") # Debugging
             try:
@@ -40,132 +142,151 @@ class SheetManager:
     def _get_sheet(self):
         if not self.client: return None
         try:
-            return self.client.open(SHEET_NAME)
+            sheet = _call_with_backoff(self.client.open, SHEET_NAME)
         except Exception as e:
             st.warning(f"'{SHEET_NAME}' 시트를 찾을 수 없습니다. ({e})")
             return None
+        
+        try:
+            self._bootstrap_tabs(sheet)
+        except Exception:
+            pass # Tabs are resolved lazily in _get_worksheet instead
+        return sheet
+
+    def _bootstrap_tabs(self, sheet):
+        """Resolves every tab with one metadata read; creates missing ones (with headers) in one batchUpdate."""
+        existing = _call_with_backoff(sheet.worksheets)
+        missing = [name for name in HEADERS if name not in {ws.title for ws in existing}]
+        
+        if missing:
+            # Pick sheet ids up front so the header writes can go in the same batch
+            next_id = max((ws.id for ws in existing), default=0) + 1
+            requests = []
+            for sheet_id, name in enumerate(missing, start=next_id):
+                requests.append({
+                    "addSheet": {
+                        "properties": {"sheetId": sheet_id, "title": name,
+                                       "gridProperties": {"rowCount": 100, "columnCount": 20}}
+                    }
+                })
+                requests.append({
+                    "updateCells": {
+                        "start": {"sheetId": sheet_id, "rowIndex": 0, "columnIndex": 0},
+                        "rows": [{"values": [_cell_data(h) for h in HEADERS[name]]}],
+                        "fields": "userEnteredValue"
+                    }
+                })
+            _call_with_backoff(sheet.batch_update, {"requests": requests})
+            self._headers_ok.update(missing)
+            existing = _call_with_backoff(sheet.worksheets)
+        
+        for ws in existing:
+            self._ws_cache[ws.title] = ws
+
+    @contextmanager
+    def _locked(self, *ws_names):
+        """Holds this process's write locks for the given worksheets (taken in sorted order)."""
+        with ExitStack() as stack:
+            for name in sorted(set(ws_names)):
+                stack.enter_context(self._write_locks[name])
+            yield
 
     def _get_worksheet(self, name):
         if not self.sheet: return None
+        if name in self._ws_cache:
+            return self._ws_cache[name]
         try:
-            return self.sheet.worksheet(name)
+            ws = _call_with_backoff(self.sheet.worksheet, name)
         except gspread.exceptions.WorksheetNotFound:
             # Create if missing
-            return self.sheet.add_worksheet(title=name, rows="100", cols="20")
+            ws = _call_with_backoff(self.sheet.add_worksheet, title=name, rows="100", cols="20")
+        self._ws_cache[name] = ws
+        return ws
 
     def _ensure_headers(self, worksheet, headers):
+        if worksheet.title in self._headers_ok: return
         try:
-            existing_headers = worksheet.row_values(1)
+            existing_headers = _call_with_backoff(worksheet.row_values, 1)
             if not existing_headers:
-                worksheet.append_row(headers)
+                _call_with_backoff(worksheet.append_row, headers)
+            elif worksheet.title == "Crops" and "Id" not in existing_headers:
+                # Sheet predates crop ids: add the column and fill it in
+                self._backfill_crop_ids(worksheet)
             elif existing_headers != headers:
                 # If headers differ, maybe warn or update? For now, assume okay.
                 pass
+            self._headers_ok.add(worksheet.title)
         except:
-             pass
+             pass # Not marked, so the check is retried on the next call
+
+    def _backfill_crop_ids(self, ws):
+        """Adds the Id header and gives every existing crop row an id (one read + one write)."""
+        with self._locked("Crops"):
+            rows = _call_with_backoff(ws.get_all_values)
+            id_col = HEADERS["Crops"].index("Id")
+            ids = [["Id"]]
+            for r in rows[1:]:
+                existing_id = r[id_col] if len(r) > id_col else ""
+                ids.append([existing_id or uuid.uuid4().hex])
+            cell_range = f"{gspread.utils.rowcol_to_a1(1, id_col + 1)}:{gspread.utils.rowcol_to_a1(len(ids), id_col + 1)}"
+            _call_with_backoff(ws.update, range_name=cell_range, values=ids)
+            _clear_read_caches()
 
     # --- Farm Data Operations ---
 
     def load_farm(self, user_nickname):
-        """Loads farm data (crops) for a specific user."""
+        """Loads farm data (crops) for a specific user.
+
+        Returns columns, not rows: {"id": [...], "ticker": [...], "buy_price": [...], "quantity": [...], "buy_date": [...]}
+        (ready for pd.DataFrame). Index i across the lists is the user's i-th crop.
+        """
+        crops = {"id": [], "ticker": [], "buy_price": [], "quantity": [], "buy_date": []}
         ws = self._get_worksheet("Crops")
-        if not ws: return []
+        if not ws: return crops
         
-        self._ensure_headers(ws, ["User", "Ticker", "BuyPrice", "Quantity", "BuyDate"])
+        headers = HEADERS["Crops"]
+        self._ensure_headers(ws, headers)
         
-        all_records = ws.get_all_records()
-        # Filter by User
-        user_crops = [r for r in all_records if str(r['User']) == user_nickname]
+        # Only the user's rows (columns in header order)
+        user_crops = _fetch_user_rows(ws, "Crops", user_nickname, len(headers))
         
-        # Convert types to match app logic
-        cleaned_crops = []
+        # Split columns into app keys (numbers are already native)
         for c in user_crops:
-            cleaned_crops.append({
-                "ticker": c['Ticker'],
-                "buy_price": float(c['BuyPrice']),
-                "quantity": int(c['Quantity']),
-                "buy_date": c['BuyDate']
-            })
-        return cleaned_crops
+            crops["id"].append(c[5])
+            crops["ticker"].append(c[1])
+            crops["buy_price"].append(c[2])
+            crops["quantity"].append(c[3])
+            crops["buy_date"].append(c[4])
+        return crops
 
-    def save_crop(self, user_nickname, crop_data):
-        """Adds a new crop."""
-        ws = self._get_worksheet("Crops")
-        row = [
+    def _crop_row(self, user_nickname, crop_data):
+        return [
             user_nickname,
             crop_data['ticker'],
             crop_data['buy_price'],
             crop_data['quantity'],
-            crop_data['buy_date']
+            crop_data['buy_date'],
+            crop_data['id']
         ]
-        ws.append_row(row)
 
-    def remove_crop(self, user_nickname, crop_idx):
-        """Removes a crop. Since we don't have unique IDs, we find by matching logic (simplified)."""
-        # This is tricky without IDs. For MVP, we will fetch all, delete the matching one from LOCAL list, 
-        # then CLEAR the sheet and RE-WRITE user's rows. (Inefficient but safe for MVP with small data)
-        
-        ws = self._get_worksheet("Crops")
-        all_records = ws.get_all_records()
-        
-        # Filter OUT the user's records to keep others
-        other_records = [r for r in all_records if str(r['User']) != user_nickname]
-        
-        # Get user's current records
-        user_records = [r for r in all_records if str(r['User']) == user_nickname]
-        
-        if 0 <= crop_idx < len(user_records):
-            user_records.pop(crop_idx) # Remove the targeted crop
-            
-        # Re-construct sheet data
-        # Headers + Other Users + Updated User Records
-        
-        # We need to explicitly clear and rewrite? 
-        # Safer: Just append `other_records` + `user_records` to a NEW list of rows
-        
-        new_rows = []
-        # Add headers first? gspread update needs range.
-        
-        # Let's use a simpler approach:
-        # Load all rows, modify in python, rewrite entire sheet.
-        # Warning: Concurrency issue if multiple users write same time. 
-        # For this demo, it's acceptable.
-        
-        final_data = other_records + user_records
-        
-        ws.clear()
-        ws.append_row(["User", "Ticker", "BuyPrice", "Quantity", "BuyDate"])
-        
-        # Bulk Upload
-        if final_data:
-            # Convert dicts back to list of values
-            rows_to_add = []
-            for r in final_data:
-                rows_to_add.append([r['User'], r['Ticker'], r['BuyPrice'], r['Quantity'], r['BuyDate']])
-            ws.append_rows(rows_to_add)
-
-    def update_crop_qty(self, user_nickname, crop_idx, new_qty):
-        """Updates quantity (partial sell)."""
-        # Similar logic to remove: Rewrite for now.
-        ws = self._get_worksheet("Crops")
-        all_records = ws.get_all_records()
-        
-        other_records = [r for r in all_records if str(r['User']) != user_nickname]
-        user_records = [r for r in all_records if str(r['User']) == user_nickname]
-        
-        if 0 <= crop_idx < len(user_records):
-            user_records[crop_idx]['Quantity'] = new_qty
-            
-        final_data = other_records + user_records
-        
-        ws.clear()
-        ws.append_row(["User", "Ticker", "BuyPrice", "Quantity", "BuyDate"])
-        
-        if final_data:
-            rows_to_add = []
-            for r in final_data:
-                rows_to_add.append([r['User'], r['Ticker'], r['BuyPrice'], r['Quantity'], r['BuyDate']])
-            ws.append_rows(rows_to_add)
+    def save_crop_with_log(self, user_nickname, crop_data, log_data):
+        """Adds a new crop and its History entry in a single API request."""
+        self.append_multi({
+            "Crops": [self._crop_row(user_nickname, crop_data)],
+            "History": [self._log_row(user_nickname, log_data)]
+        })
+
+    def _find_crop_row(self, ws, user_nickname, crop_id):
+        """Returns (sheet row, current quantity) of user_nickname's crop_id, or (None, None) (one read)."""
+        if not crop_id: return None, None
+        id_col = HEADERS["Crops"].index("Id")
+        qty_col = HEADERS["Crops"].index("Quantity")
+        last_col = gspread.utils.rowcol_to_a1(1, id_col + 1).rstrip("1")
+        values = _call_with_backoff(ws.get_values, f"A:{last_col}", value_render_option="UNFORMATTED_VALUE")
+        for row_num, row in enumerate(values[1:], start=2): # Skip headers
+            if len(row) > id_col and row[id_col] == crop_id and str(row[0]) == user_nickname:
+                return row_num, row[qty_col]
+        return None, None
 
     # --- History Operations ---
 
@@ -173,29 +294,28 @@ class SheetManager:
         ws = self._get_worksheet("History")
         if not ws: return []
         
-        self._ensure_headers(ws, ["User", "Time", "Type", "Ticker", "Price", "Quantity", "Date", "ProfitRate", "ProfitAmt"])
+        headers = HEADERS["History"]
+        self._ensure_headers(ws, headers)
         
-        all_records = ws.get_all_records()
-        user_logs = [r for r in all_records if str(r['User']) == user_nickname]
+        user_logs = _fetch_user_rows(ws, "History", user_nickname, len(headers))
         
-        # Convert keys to lowercase for app compatibility
+        # Map columns to lowercase keys for app compatibility (numbers are already native)
         cleaned_logs = []
         for l in user_logs:
             cleaned_logs.append({
-                "time": l['Time'],
-                "type": l['Type'],
-                "ticker": l['Ticker'],
-                "price": float(l['Price']),
-                "quantity": int(l['Quantity']),
-                "date": l['Date'],
-                "profit_rate": float(l['ProfitRate']) if l['ProfitRate'] != '' else None,
-                "profit_amt": float(l['ProfitAmt']) if l['ProfitAmt'] != '' else None
+                "time": l[1],
+                "type": l[2],
+                "ticker": l[3],
+                "price": l[4],
+                "quantity": l[5],
+                "date": l[6],
+                "profit_rate": l[7] if l[7] not in ('', None) else None,
+                "profit_amt": l[8] if l[8] not in ('', None) else None
             })
         return cleaned_logs
 
-    def log_transaction(self, user_nickname, log_data):
-        ws = self._get_worksheet("History")
-        row = [
+    def _log_row(self, user_nickname, log_data):
+        return [
             user_nickname,
             log_data['time'],
             log_data['type'],
@@ -206,29 +326,93 @@ class SheetManager:
             log_data['profit_rate'] if log_data['profit_rate'] is not None else "",
             log_data['profit_amt'] if log_data['profit_amt'] is not None else ""
         ]
-        ws.append_row(row)
+
+    # --- Batch Operations ---
+
+    def _append_cells_request(self, ws, rows):
+        return {
+            "appendCells": {
+                "sheetId": ws.id,
+                "rows": [{"values": [_cell_data(v) for v in row]} for row in rows],
+                "fields": "userEnteredValue"
+            }
+        }
+
+    def append_multi(self, rows_by_sheet):
+        """Appends rows to several worksheets with one spreadsheets.batchUpdate call.
+
+        rows_by_sheet maps a worksheet name to a list of rows (lists of values).
+        """
+        requests = [self._append_cells_request(self._get_worksheet(name), rows)
+                    for name, rows in rows_by_sheet.items() if rows]
+        if requests:
+            with self._locked(*rows_by_sheet):
+                _call_with_backoff(self.sheet.batch_update, {"requests": requests})
+                _clear_read_caches()
+
+    def harvest_crop(self, user_nickname, crop_id, expected_qty, qty_to_sell, log_data):
+        """Sells qty_to_sell from a crop and logs it in one batchUpdate. Selling everything removes the crop row.
+        Returns False (and writes nothing) if the crop is gone or its quantity is no longer expected_qty,
+        i.e. it changed since the caller loaded it."""
+        with self._locked("Crops", "History"):
+            crops_ws = self._get_worksheet("Crops")
+            history_ws = self._get_worksheet("History")
+            target_row, current_qty = self._find_crop_row(crops_ws, user_nickname, crop_id)
+            if not target_row or current_qty != expected_qty:
+                _clear_read_caches() # The caller's copy is stale; let its refresh read the sheet again
+                return False
+            new_qty = current_qty - qty_to_sell
+
+            requests = []
+            if new_qty <= 0:
+                requests.append({
+                    "deleteDimension": {
+                        "range": {"sheetId": crops_ws.id, "dimension": "ROWS",
+                                  "startIndex": target_row - 1, "endIndex": target_row}
+                    }
+                })
+            else:
+                requests.append({
+                    "updateCells": {
+                        "start": {"sheetId": crops_ws.id, "rowIndex": target_row - 1, "columnIndex": 3}, # Quantity (D)
+                        "rows": [{"values": [_cell_data(new_qty)]}],
+                        "fields": "userEnteredValue"
+                    }
+                })
+            requests.append(self._append_cells_request(history_ws, [self._log_row(user_nickname, log_data)]))
+            _call_with_backoff(self.sheet.batch_update, {"requests": requests})
+            _clear_read_caches()
+            return True
 
     # --- Auth Operations ---
     
     def _hash_password(self, password):
-        import hashlib
-        return hashlib.sha256(password.encode()).hexdigest()
+        return hashlib.sha256(password.encode('utf-8')).hexdigest()
+
+    def _get_users_map(self, ws, refresh=False):
+        """Returns the cached {nickname: password_hash} map, reloading it with one read when stale."""
+        if refresh or time.time() - _users_cache["ts"] > USERS_CACHE_TTL:
+            rows = _call_with_backoff(ws.get_all_values)[1:] # Skip headers
+            _users_cache["map"] = {r[0]: (r[1] if len(r) > 1 else "") for r in rows if r and r[0]}
+            _users_cache["ts"] = time.time()
+        return _users_cache["map"]
 
     def register_user(self, nickname, password):
         """Registers a new user. Returns True if successful, False if nickname exists."""
         ws = self._get_worksheet("Users")
         if not ws: return False
         
-        self._ensure_headers(ws, ["Nickname", "PasswordHash"])
+        self._ensure_headers(ws, HEADERS["Users"])
         
-        # Check if exists
-        try:
-            cell = ws.find(nickname)
-            if cell: return False # Already exists
-        except gspread.exceptions.CellNotFound:
-            pass # Good, doesn't exist
+        # Check and append under the Users lock (against a fresh read), so sign-ups in this process can't duplicate
+        with self._locked("Users"):
+            if nickname in self._get_users_map(ws, refresh=True):
+                return False
 
-        ws.append_row([nickname, self._hash_password(password)])
+            password_hash = self._hash_password(password)
+            _call_with_backoff(ws.append_row, [nickname, password_hash])
+            _users_cache["map"][nickname] = password_hash
+            _clear_read_caches()
         return True
 
     def login_user(self, nickname, password):
@@ -236,25 +420,28 @@ class SheetManager:
         ws = self._get_worksheet("Users")
         if not ws: return False
         
-        self._ensure_headers(ws, ["Nickname", "PasswordHash"])
+        self._ensure_headers(ws, HEADERS["Users"])
         
         try:
-            cell = ws.find(nickname)
-            if not cell: return False
+            users = self._get_users_map(ws)
+            if nickname not in users:
+                # Might have registered since the last refresh
+                users = self._get_users_map(ws, refresh=True)
+            if nickname not in users: return False
             
-            # Get hash from next column
-            stored_hash = ws.cell(cell.row, cell.col + 1).value
-            return stored_hash == self._hash_password(password)
+            return hmac.compare_digest(users[nickname], self._hash_password(password))
         except:
             return False
 
-    def get_all_users(self):
-        """Returns a list of all nicknames."""
+    def get_all_users(self, refresh=False):
+        """Returns a list of all nicknames. refresh=True skips the cached read (e.g. for an explicit refresh)."""
         ws = self._get_worksheet("Users")
         if not ws: return []
         
         try:
-            records = ws.get_all_records()
+            if refresh:
+                _fetch_all_records.clear() # Picks up users added by other processes or by hand
+            records = _fetch_all_records(ws, "Users")
             return [r['Nickname'] for r in records if r['Nickname']]
         except:
             return []
@@ -263,19 +450,20 @@ class SheetManager:
 
     def add_guestbook_message(self, receiver, sender, message):
         ws = self._get_worksheet("Guestbook")
-        self._ensure_headers(ws, ["Receiver", "Sender", "Message", "Date"])
+        self._ensure_headers(ws, HEADERS["Guestbook"])
         
         current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         row = [receiver, sender, message, current_time]
-        ws.append_row(row)
+        _call_with_backoff(ws.append_row, row)
+        _clear_read_caches()
 
     def get_guestbook_messages(self, receiver):
         ws = self._get_worksheet("Guestbook")
         if not ws: return []
         
-        self._ensure_headers(ws, ["Receiver", "Sender", "Message", "Date"])
+        self._ensure_headers(ws, HEADERS["Guestbook"])
         
-        all_records = ws.get_all_records()
+        all_records = _fetch_all_records(ws, "Guestbook")
         # Filter by Receiver
         msgs = [r for r in all_records if str(r['Receiver']) == receiver]
         return msgs
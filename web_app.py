@@ -2,35 +2,105 @@ import streamlit as st
 import yfinance as yf
 import datetime
 import pandas as pd
+import numpy as np
 import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from sheet_manager import SheetManager
 
 # --- Config & Setup ---
 st.set_page_config(page_title="주식 농장 (Stock Farm)", page_icon="🌿", layout="wide")
+PRICE_BATCH_SIZE = 20 # Tickers per yf.download call
+PRICE_FETCH_WORKERS = 16 # Max concurrent per-ticker price requests
+
+# Table column formats (rendered client-side, so columns stay numeric and sortable)
+USD_COLUMN = st.column_config.NumberColumn(format="$%.2f")
+PCT_COLUMN = st.column_config.NumberColumn(format="%.2f%%")
 
 # --- Helper Functions ---
-def get_current_price(ticker):
+@st.cache_resource
+def get_sheet_manager():
+    """One SheetManager (gspread client + HTTP session) per process, shared across sessions."""
+    return SheetManager()
+
+def _fetch_price(ticker):
     try:
         return yf.Ticker(ticker).fast_info.last_price
     except:
         return 0.0
 
+@st.cache_data(ttl=60, show_spinner=False)
+def _cached_price(ticker):
+    price = _fetch_price(ticker)
+    if not (price and price > 0):
+        raise LookupError(ticker) # Exceptions aren't cached, so a failed lookup is retried on the next run
+    return price
+
+def get_current_price(ticker):
+    """Last price for one ticker (cached for a minute when found), or 0.0 if it can't be fetched."""
+    try:
+        return _cached_price(ticker)
+    except LookupError:
+        return 0.0
+
+def _download_last_closes(tickers):
+    """One yf.download for a chunk of tickers -> {ticker: last close}. Tickers without data are omitted."""
+    closes = {}
+    try:
+        data = yf.download(list(tickers), period="1d", progress=False, threads=True, group_by="ticker")
+    except:
+        return closes
+    
+    for t in tickers:
+        try:
+            close = data[t]["Close"] if isinstance(data.columns, pd.MultiIndex) else data["Close"]
+            closes[t] = float(close.dropna().iloc[-1])
+        except:
+            pass
+    return closes
+
+@st.cache_data(ttl=60, show_spinner=False)
+def get_current_prices(tickers):
+    """Fetches last prices for many tickers with one batched download.
+    tickers must be a hashable tuple (sorted, for a stable cache key). Failed tickers map to 0.0."""
+    prices = {t: 0.0 for t in tickers}
+    for i in range(0, len(tickers), PRICE_BATCH_SIZE):
+        prices.update(_download_last_closes(tickers[i:i + PRICE_BATCH_SIZE]))
+    
+    # Retry whatever the batch missed one by one, concurrently (network-bound)
+    missing = [t for t in tickers if not prices[t] > 0]
+    if missing:
+        with ThreadPoolExecutor(max_workers=min(PRICE_FETCH_WORKERS, len(missing))) as ex:
+            # fast_info yields None/NaN for symbols without data; keep the 0.0 for those
+            prices.update({t: p for t, p in zip(missing, ex.map(_fetch_price, missing)) if p and p > 0})
+    return prices
+
+@st.cache_data(max_entries=32, show_spinner=False) # Superseded histories age out
+def _history_df(history):
+    """Ledger DataFrame for show_history, cached on the history content (a new trade is a new key)."""
+    # Newest first by trade time (back-dated entries land in their own month);
+    # reversing first keeps later-logged rows ahead on equal times
+    df = pd.DataFrame(history).iloc[::-1].sort_values('time', ascending=False, kind='stable').reset_index(drop=True)
+    df['total'] = df['price'] * df['quantity']
+    if 'date' in df.columns:
+        df['month'] = pd.to_datetime(df['date'], format="%Y-%m-%d").dt.to_period('M')
+    return df
+
 def get_status_emoji(profit_rate):
-    if profit_rate < -20: return "☠️"
-    elif profit_rate < 0: return "🍂"
-    elif profit_rate < 10: return "🌱"
-    else: return "🌳"
+    """Maps profit rate(s) to a status emoji. Accepts a scalar or an array/Series."""
+    profit_rate = np.asarray(profit_rate)
+    emojis = np.select([pd.isna(profit_rate), profit_rate < -20, profit_rate < 0, profit_rate < 10],
+                       ["❓", "☠️", "🍂", "🌱"], "🌳") # NaN: no price quote
+    return emojis.item() if emojis.ndim == 0 else emojis
 
 # --- Main App ---
 def main():
     st.title("🌿 주식 농장 (Stock Farm)")
     
-    # 1. Initialize Sheet Manager
-    if "sheet_manager" not in st.session_state:
-        st.session_state.sheet_manager = SheetManager()
-        
-    sm = st.session_state.sheet_manager
-    if not sm.client:
+    # 1. Initialize Sheet Manager (shared by all sessions)
+    sm = get_sheet_manager()
+    if not sm.client or not sm.sheet:
+        get_sheet_manager.clear() # Don't keep a failed connection; retry on next run
         st.stop() # Stop if connection failed
 
     # 2. Authentication (Login/Register)
@@ -85,7 +155,7 @@ def main():
     
     # Refresh user list button
     if st.sidebar.button("🔄 사용자 목록 갱신"):
-        st.session_state.all_users = sm.get_all_users()
+        st.session_state.all_users = sm.get_all_users(refresh=True)
         st.rerun()
         
     all_users_list = st.session_state.all_users
@@ -116,21 +186,28 @@ def main():
     
     menu = st.sidebar.radio("메뉴", menu_options)
     
-    # Load Data for Target User
-    crops = sm.load_farm(target_user)
-    history = sm.load_history(target_user)
+    # Prices are cached for a minute; allow a manual refresh
+    if st.sidebar.button("💹 시세 새로고침"):
+        _cached_price.clear()
+        get_current_prices.clear()
+        st.rerun()
     
+    # Each page is a fragment: it loads only the data it needs, and its own widgets rerun just that page
     if menu == "농장 (Farm)":
-        show_farm(sm, crops, history, target_user, user)
+        show_farm(sm, target_user, user)
     elif menu == "작물 심기 (Plant)":
         show_plant(sm, user) # Only owner accesses this
     elif menu == "수확 하기 (Harvest)":
-        show_harvest(sm, user, crops) # Only owner accesses this
+        show_harvest(sm, user) # Only owner accesses this
     elif menu == "장부 (History)":
-        show_history(history)
+        show_history(sm, target_user)
 
-def show_farm(sm, crops, history, target_user, logged_in_user):
+@st.fragment
+def show_farm(sm, target_user, logged_in_user):
     st.header("🏡 농장 현황")
+    
+    crops = sm.load_farm(target_user)
+    history = sm.load_history(target_user)
 
     # --- Asset Growth Chart ---
     if history:
@@ -160,47 +237,43 @@ def show_farm(sm, crops, history, target_user, logged_in_user):
             st.subheader("📈 자산 성장 그래프")
             st.info("아직 수확(매도) 이력이 없어 그래프가 표시되지 않습니다. 작물을 수확해보세요!")
 
-    if not crops:
+    if not crops["ticker"]:
         st.info("농장이 비어있습니다.")
     else:
-        # Process Data for Display
-        rows = []
-        total_buy = 0
-        total_val = 0
+        # Fetch all prices at once (deduplicated, cached per ticker set)
+        tickers = tuple(sorted(set(crops["ticker"])))
+        with st.spinner(f"Fetching prices for {len(tickers)} tickers..."):
+            prices = get_current_prices(tickers)
         
-        progress_bar = st.progress(0)
-        status_text = st.empty()
+        # Process Data for Display (vectorized over all crops)
+        df = pd.DataFrame(crops)
+        df['current'] = df['ticker'].map(prices).where(lambda c: c > 0) # Failed quote (0.0) -> NaN, shown as ❓
+        df['profit_rate'] = np.where(df['buy_price'] > 0, (df['current'] - df['buy_price']) / df['buy_price'] * 100, 0.0)
+        df['profit_amt'] = (df['current'] - df['buy_price']) * df['quantity']
         
-        for i, crop in enumerate(crops):
-            status_text.text(f"Updating {crop['ticker']}...")
-            current_price = get_current_price(crop["ticker"])
-            progress_bar.progress((i + 1) / len(crops))
-            
-            profit_rate = ((current_price - crop["buy_price"]) / crop["buy_price"]) * 100 if crop["buy_price"] > 0 else 0
-            profit_amt = (current_price - crop["buy_price"]) * crop["quantity"]
-            
-            # Daily Logic
-            buy_dt = datetime.datetime.strptime(crop["buy_date"], "%Y-%m-%d")
-            days = max(1, (datetime.datetime.now() - buy_dt).days)
-            daily_rate = profit_rate / days
-            
-            total_buy += crop["buy_price"] * crop["quantity"]
-            total_val += current_price * crop["quantity"]
-            
-            rows.append({
-                "상태": get_status_emoji(profit_rate),
-                "종목": crop["ticker"],
-                "매수가": f"${crop['buy_price']:.2f}",
-                "현재가": f"${current_price:.2f}",
-                "수익률": f"{profit_rate:.2f}%",
-                "일간": f"{daily_rate:.2f}%/일",
-                "수익금": f"${profit_amt:.2f}",
-                "수량": crop["quantity"],
-                "매수일": crop["buy_date"]
-            })
+        # Daily Logic
+        df['days'] = np.maximum(1, (pd.Timestamp.now() - pd.to_datetime(df['buy_date'], format="%Y-%m-%d")).dt.days)
+        df['daily_rate'] = df['profit_rate'] / df['days']
         
-        status_text.empty()
-        progress_bar.empty()
+        # Totals cover only crops with a quote, so a failed lookup doesn't read as a -100% loss
+        priced = df[df['current'].notna()]
+        total_buy = (priced['buy_price'] * priced['quantity']).sum()
+        total_val = (priced['current'] * priced['quantity']).sum()
+        unpriced = sorted(set(df.loc[df['current'].isna(), 'ticker']))
+        if unpriced:
+            st.warning(f"현재가를 가져오지 못한 종목은 합계에서 제외됩니다: {', '.join(unpriced)}")
+        
+        display_df = pd.DataFrame({
+            "상태": get_status_emoji(df['profit_rate']),
+            "종목": df['ticker'],
+            "매수가": df['buy_price'],
+            "현재가": df['current'],
+            "수익률": df['profit_rate'],
+            "일간": df['daily_rate'],
+            "수익금": df['profit_amt'],
+            "수량": df['quantity'],
+            "매수일": df['buy_date']
+        })
         
         # Summary Metrics
         if total_buy > 0:
@@ -213,7 +286,10 @@ def show_farm(sm, crops, history, target_user, logged_in_user):
             col3.metric("총 수익", f"${total_profit:,.2f}", f"{total_profit_rate:.2f}%")
         
         # DataFrame Display
-        st.dataframe(pd.DataFrame(rows), use_container_width=True)
+        st.dataframe(display_df, use_container_width=True, column_config={
+            "매수가": USD_COLUMN, "현재가": USD_COLUMN, "수익률": PCT_COLUMN,
+            "일간": st.column_config.NumberColumn(format="%.2f%%/일"), "수익금": USD_COLUMN
+        })
 
     st.divider()
     
@@ -241,24 +317,35 @@ def show_farm(sm, crops, history, target_user, logged_in_user):
     else:
         st.caption("아직 방명록 메시지가 없습니다. 첫 번째 메시지를 남겨보세요!")
 
+@st.fragment
 def show_plant(sm, user):
     st.header("🌱 작물 심기 (매수)")
     
     # 1. Ticker Input OUTSIDE form
     ticker = st.text_input("종목 코드 (예: AAPL)", key="plant_ticker").upper()
     
-    price_guess = 0.01 
-    if ticker:
-         st.caption(f"Fetching current price for {ticker}...")
-         fetched_price = get_current_price(ticker)
-         if fetched_price > 0:
-             price_guess = fetched_price
-         st.markdown(f"**현재 추정가: ${price_guess:.2f}**")
+    # 2. Look up the price only on request, not on every rerun while the ticker is edited
+    price_key = f"price_{ticker}"
+    if st.button("현재가 조회", disabled=not ticker):
+        with st.spinner(f"Fetching current price for {ticker}..."):
+            fetched_price = get_current_price(ticker)
+        st.session_state.plant_quote = (ticker, fetched_price)
+        if fetched_price > 0:
+            st.session_state[price_key] = fetched_price # Prefill the price field below
+    
+    quote = st.session_state.get("plant_quote")
+    if ticker and quote and quote[0] == ticker:
+        if quote[1] > 0:
+            if price_key not in st.session_state:
+                st.session_state[price_key] = quote[1] # Widget state is dropped when the ticker changes
+            st.markdown(f"**현재 추정가: ${quote[1]:.2f}**")
+        else:
+            st.caption(f"{ticker} 현재가를 가져오지 못했습니다.")
     
     with st.form("plant_form"):
         date_picked = st.date_input("매수 날짜", datetime.date.today())
         
-        price = st.number_input("매수가 ($)", min_value=0.01, value=price_guess, format="%.2f", key=f"price_{ticker}")
+        price = st.number_input("매수가 ($)", min_value=0.01, format="%.2f", key=price_key)
         qty = st.number_input("수량", min_value=1, value=1)
         
         submitted = st.form_submit_button("심기 (확인)")
@@ -267,19 +354,18 @@ def show_plant(sm, user):
             if not ticker:
                 st.error("종목 코드를 입력하세요.")
             else:
+                date_str = date_picked.isoformat() # YYYY-MM-DD
                 new_crop = {
+                    "id": uuid.uuid4().hex,
                     "ticker": ticker,
                     "buy_price": price,
                     "quantity": qty,
-                    "buy_date": date_picked.strftime("%Y-%m-%d")
+                    "buy_date": date_str
                 }
                 
-                # Save to Sheet
-                sm.save_crop(user, new_crop)
-                
                 # Log Transaction
                 current_time_str = datetime.datetime.now().strftime("%H:%M:%S")
-                timestamp = f"{date_picked.strftime('%Y-%m-%d')} {current_time_str}"
+                timestamp = f"{date_str} {current_time_str}"
                 
                 log = {
                     "time": timestamp,
@@ -287,29 +373,36 @@ def show_plant(sm, user):
                     "ticker": ticker,
                     "price": price,
                     "quantity": qty,
-                    "date": date_picked.strftime("%Y-%m-%d"),
+                    "date": date_str,
                     "profit_rate": None,
                     "profit_amt": None
                 }
-                sm.log_transaction(user, log)
+                
+                # Save crop + log to Sheet in one request
+                sm.save_crop_with_log(user, new_crop, log)
                 
                 st.success(f"{ticker} {qty}주를 심었습니다!")
-                st.cache_data.clear()
 
-def show_harvest(sm, user, crops):
+@st.fragment
+def show_harvest(sm, user):
     st.header("🚜 수확 하기 (매도)")
     
-    if not crops:
+    crops = sm.load_farm(user)
+    
+    if not crops["ticker"]:
         st.warning("수확할 작물이 없습니다.")
         return
 
-    # Select Crop
-    crop_options = [f"{i}: {c['ticker']} (매수: ${c['buy_price']:.2f}, 수량: {c['quantity']})" for i, c in enumerate(crops)]
-    selected_idx_str = st.selectbox("작물 선택", crop_options)
+    # Select Crop (by id, so the selection survives rows being added/removed)
+    pos = {crop_id: i for i, crop_id in enumerate(crops["id"])}
+    crop_id = st.selectbox(
+        "작물 선택", crops["id"],
+        format_func=lambda c: f"{pos[c]}: {crops['ticker'][pos[c]]} (매수: ${crops['buy_price'][pos[c]]:.2f}, 수량: {crops['quantity'][pos[c]]})"
+    )
     
-    if selected_idx_str:
-        idx = int(selected_idx_str.split(":")[0])
-        target_crop = crops[idx]
+    if crop_id is not None:
+        idx = pos[crop_id]
+        target_crop = {k: v[idx] for k, v in crops.items()}
         
         with st.form("harvest_form"):
             st.info(f"선택됨: {target_crop['ticker']} (보유: {target_crop['quantity']}주)")
@@ -317,7 +410,7 @@ def show_harvest(sm, user, crops):
             qty_to_sell = st.number_input("수확(매도) 수량", min_value=1, max_value=target_crop["quantity"], value=target_crop["quantity"])
             
             current_price_guess = get_current_price(target_crop['ticker'])
-            sell_price = st.number_input("매도 단가 ($)", min_value=0.01, value=current_price_guess, format="%.2f")
+            sell_price = st.number_input("매도 단가 ($)", min_value=0.01, value=max(current_price_guess, 0.01), format="%.2f")
             
             sell_date = st.date_input("매도 날짜", datetime.date.today())
 
@@ -328,20 +421,10 @@ def show_harvest(sm, user, crops):
                 profit_rate = ((sell_price - target_crop["buy_price"]) / target_crop["buy_price"]) * 100
                 profit_amt = (sell_price - target_crop["buy_price"]) * qty_to_sell
                 
-                # Update Sheet
-                if qty_to_sell == target_crop["quantity"]:
-                    # Full Sell
-                    sm.remove_crop(user, idx) # Note: index based removal relies on list view stability
-                    st.success(f"{target_crop['ticker']} 전체 수확 완료!")
-                else:
-                    # Partial Sell
-                    new_qty = target_crop["quantity"] - qty_to_sell
-                    sm.update_crop_qty(user, idx, new_qty)
-                    st.success(f"{target_crop['ticker']} {qty_to_sell}주 부분 수확 완료!")
-
                 # Log
+                date_str = sell_date.isoformat() # YYYY-MM-DD
                 current_time_str = datetime.datetime.now().strftime("%H:%M:%S")
-                timestamp = f"{sell_date.strftime('%Y-%m-%d')} {current_time_str}"
+                timestamp = f"{date_str} {current_time_str}"
                 
                 log = {
                     "time": timestamp,
@@ -349,28 +432,41 @@ def show_harvest(sm, user, crops):
                     "ticker": target_crop['ticker'],
                     "price": sell_price,
                     "quantity": qty_to_sell,
-                    "date": sell_date.strftime("%Y-%m-%d"),
+                    "date": date_str,
                     "profit_rate": profit_rate,
                     "profit_amt": profit_amt
                 }
-                sm.log_transaction(user, log)
+                
+                # Update Sheet (crop row + log in one request), only if the crop is unchanged since it was loaded
+                if not sm.harvest_crop(user, crop_id, target_crop["quantity"], qty_to_sell, log):
+                    st.error("내용이 변경되었습니다. 새로고침 후 다시 시도하세요.")
+                    return
+                new_qty = target_crop["quantity"] - qty_to_sell
+                if new_qty <= 0:
+                    # Full Sell
+                    st.success(f"{target_crop['ticker']} 전체 수확 완료!")
+                else:
+                    # Partial Sell
+                    st.success(f"{target_crop['ticker']} {qty_to_sell}주 부분 수확 완료!")
                 
                 st.rerun()
 
-def show_history(history):
+@st.fragment
+def show_history(sm, target_user):
     st.header("📜 거래 장부 (History)")
     
+    history = sm.load_history(target_user)
+    
     if not history:
         st.info("거래 내역이 없습니다.")
         return
 
     # Grouping Logic
-    history_rev = history[::-1]
-    df = pd.DataFrame(history_rev)
+    df = _history_df(history)
     
     # Calculate Totals
-    total_buy = df[df['type'] == '매수'].apply(lambda x: x['price'] * x['quantity'], axis=1).sum()
-    total_sell = df[df['type'] == '매도'].apply(lambda x: x['price'] * x['quantity'], axis=1).sum()
+    total_buy = df.loc[df['type'] == '매수', 'total'].sum()
+    total_sell = df.loc[df['type'] == '매도', 'total'].sum()
     total_profit = df['profit_amt'].sum()
     
     c1, c2, c3 = st.columns(3)
@@ -378,27 +474,23 @@ def show_history(history):
     c2.metric("총 매도액", f"${total_sell:,.2f}")
     c3.metric("확정 수익", f"${total_profit:,.2f}", delta_color="normal")
 
-    if 'date' in df.columns:
-        df['month'] = df['date'].apply(lambda x: x[:7]) # YYYY-MM
-        months = df['month'].unique()
+    if 'month' in df.columns:
+        grouped = df.groupby('month')
+        agg = grouped.agg(cnt=('type', 'size'), m_profit=('profit_amt', 'sum')).sort_index(ascending=False) # Newest month first
         
-        for month in months:
-            month_data = df[df['month'] == month]
-            cnt = len(month_data)
-            m_profit = month_data['profit_amt'].sum()
-            m_profit_str = f"${m_profit:,.2f}"
+        for month, stats in agg.iterrows():
+            month_data = grouped.get_group(month)
+            m_profit_str = f"${stats['m_profit']:,.2f}"
             
-            with st.expander(f"{month} (거래 {cnt}건, 수익: {m_profit_str})", expanded=True):
-                month_data['total'] = month_data['price'] * month_data['quantity']
-                
-                display_df = month_data[['time', 'type', 'ticker', 'price', 'quantity', 'profit_rate', 'profit_amt', 'total']].copy()
-                
-                display_df.rename(columns={
+            with st.expander(f"{str(month)} (거래 {int(stats['cnt'])}건, 수익: {m_profit_str})", expanded=True):
+                display_df = month_data[['time', 'type', 'ticker', 'price', 'quantity', 'profit_rate', 'profit_amt', 'total']].rename(columns={
                     'time': '일자', 'type': '구분', 'ticker': '종목', 'price': '단가',
                     'quantity': '수량', 'profit_rate': '수익률', 'profit_amt': '수익금', 'total': '총 거래액'
-                }, inplace=True)
+                })
                 
-                st.dataframe(display_df, use_container_width=True, hide_index=True)
+                st.dataframe(display_df, use_container_width=True, hide_index=True, column_config={
+                    '단가': USD_COLUMN, '수익률': PCT_COLUMN, '수익금': USD_COLUMN, '총 거래액': USD_COLUMN
+                })
     else:
         st.dataframe(df)
 